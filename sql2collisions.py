@@ -3,17 +3,102 @@
 import argparse
 import json
 import os
+import pickle
 import sqlite3
 import sys
-import xml
 
-from collections import defaultdict, namedtuple
-from copy import deepcopy
-from xml.sax.handler import ContentHandler
-from statistics import stdev
+import numpy as np
+import shapely
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby, tee
+from lxml import etree
+from numba import njit, prange, set_num_threads
 from shapely.geometry import Point, LineString
 from shapely.strtree import STRtree
-from shapely import speedups
+
+if int(shapely.__version__.split('.')[0]) < 2:
+    raise ImportError(f'shapely >= 2.0 is required, found {shapely.__version__}')
+
+SQL_CREATE_INDEX = 'create index if not exists idx_run_sec on results (run_id, seconds);'
+
+SQL_CREATE_TABLE_COLLISIONS = '''
+create table if not exists collisions (
+    leader_node_id integer,
+    follower_node_id integer,
+    seconds real,
+    lane_id string,
+    primary key (leader_node_id, follower_node_id, seconds)
+);
+'''
+
+SQL_INSERT_COLLISION = 'insert or ignore into collisions values (?, ?, ?, ?);'
+
+SQL_MIN_SECONDS = 'select min(seconds) from results where run_id = ?'
+
+SQL_MAX_SECONDS = 'select max(seconds) from results where run_id = ?'
+
+SQL_INSTANTS = '''
+select distinct seconds from results
+where seconds >= ?
+and seconds <= ?
+order by seconds asc;
+'''
+
+# unless all snapshots are requested, only whole-second rows are fetched
+SQL_WINDOW = '''
+select node_id, seconds, controller, mobility_posx, mobility_posy, appl_speed
+from results
+where run_id = ?
+and seconds >= ?
+and seconds <= ?
+and mobility_posx is not null
+and mobility_posy is not null
+and appl_speed is not null
+and (? or seconds = cast(seconds as integer))
+order by seconds asc;
+'''
+
+SQL_DROP_RTREE = 'drop table if exists temp.rtree_positions;'
+
+SQL_CREATE_RTREE = 'create virtual table temp.rtree_positions using rtree(id, minx, maxx, miny, maxy, mint, maxt);'
+
+# filtered to whole seconds like SQL_WINDOW, as only those instants are joined
+SQL_FILL_RTREE = '''
+insert into temp.rtree_positions
+select rowid, mobility_posx, mobility_posx, mobility_posy, mobility_posy, seconds, seconds
+from results
+where run_id = ?
+and seconds >= ?
+and seconds <= ?
+and mobility_posx is not null
+and mobility_posy is not null
+and appl_speed is not null
+and (? or seconds = cast(seconds as integer));
+'''
+
+# the R*Tree stores 32-bit bounds, so candidates are filtered again on the exact values
+SQL_RTREE_PAIRS = '''
+select a.node_id, b.node_id
+from results a, temp.rtree_positions rt, results b
+where a.run_id = :run_id
+and a.seconds = :instant
+and a.mobility_posx is not null
+and a.mobility_posy is not null
+and a.appl_speed is not null
+and rt.minx <= a.mobility_posx + a.appl_speed * :ttc
+and rt.maxx >= a.mobility_posx - a.appl_speed * :ttc
+and rt.miny <= a.mobility_posy + a.appl_speed * :ttc
+and rt.maxy >= a.mobility_posy - a.appl_speed * :ttc
+and rt.mint <= a.seconds
+and rt.maxt >= a.seconds
+and b.rowid = rt.id
+and b.seconds = a.seconds
+and b.node_id != a.node_id
+and (b.mobility_posx - a.mobility_posx) * (b.mobility_posx - a.mobility_posx)
+    + (b.mobility_posy - a.mobility_posy) * (b.mobility_posy - a.mobility_posy)
+    <= (a.appl_speed * :ttc) * (a.appl_speed * :ttc);
+'''
 
 DEBUG = False
 def dbg(msg):
@@ -21,6 +106,9 @@ def dbg(msg):
         sys.stderr.write(msg)
         sys.stderr.write('\n')
 
+def fmt_pos(xy):
+    return f"({xy[0]:.2f}, {xy[1]:.2f})"
+
 # This class translates between SUMO and OMNeT++ coordinates.
 # Based on VEINS' TraCICoordinateTransformation class.
 class CoordTransformer:
@@ -29,171 +117,343 @@ class CoordTransformer:
         self._topleft = topleft
         self._bottomright = bottomright
         self._margin = margin
+        # omnet2traci is the affine map x' = x + ax, y' = ay - y
+        self._ax = topleft.x - margin
+        self._ay = self._dimensions.y + topleft.y + margin
 
     def omnet2traci(self, p):
-        return Point(p.x + self._topleft.x - self._margin, self._dimensions.y - (p.y - self._topleft.y) + self._margin)
+        return Point(p.x + self._ax, self._ay - p.y)
+
+    # omnet2traci_arr is omnet2traci for arrays of x and y values
+    def omnet2traci_arr(self, x, y):
+        return x + self._ax, self._ay - y
     
     def traci2omnet(self, p):
         return Point(p.x - self._topleft.x + self._margin, self._dimensions.y - (p.y - self._topleft.y) + self._margin)
 
 
 # Class for reading a SUMO network XML file
-class NetReader(ContentHandler):
+class NetReader:
     def __init__(self):
-        self._edge_id = None
         self._data = []
-    
-    def startElement(self, name, attrs):
-        if name == "edge":
-            self._edge_id = attrs.get("id")
-        
-        if name == "lane":
-            points = []
-            for s in attrs.get("shape", "").split(" "):
-                parts = s.split(",")
-                p = Point(float(parts[0]), float(parts[1]))
-                points.append(p) # this is a raw TraCI point
-
-            self._data.append({
-                "edge_id": self._edge_id,
-                "lane_id": attrs["id"],
-                "index":   int(attrs.get("index", -1)),
-                "speed":   float(attrs.get("speed", -1)),
-                "length":  float(attrs.get("length", -1)),
-                "points":  LineString(points),
-            })
-            return
+
+    def parse(self, netfile):
+        for _, elem in etree.iterparse(netfile, events=("end",), tag=("edge", "lane")):
+            if elem.tag == "lane":
+                # raw TraCI points "x1,y1 x2,y2 ..." parsed in one pass
+                points = np.fromstring(elem.get("shape", "").replace(",", " "), sep=" ").reshape(-1, 2)
+
+                self._data.append({
+                    "edge_id": elem.getparent().get("id"),
+                    "lane_id": elem.get("id"),
+                    "index":   int(elem.get("index", -1)),
+                    "speed":   float(elem.get("speed", -1)),
+                    "length":  float(elem.get("length", -1)),
+                    "points":  LineString(points),
+                })
+                elem.clear()
+                continue
+
+            # edges are done with once all their lanes are read
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
 # EdgeLookup is a class for looking up the lane on which a given vehicle is travelling
 class EdgeLookup:
     def __init__(self, netfile: str, xformer: CoordTransformer):
-        xp = xml.sax.make_parser()
-        xp.setFeature(xml.sax.handler.feature_namespaces, 0)
-        r = NetReader()
-        xp.setContentHandler(r)
-        xp.parse(netfile)
-        self._lanes = deepcopy(r._data)
-        self._lane_lookup = dict([(id(l['points']), l) for l in self._lanes])
+        self._lanes = self._read_lanes(netfile)
         self._edge_rtree = STRtree([l['points'] for l in self._lanes])
         self._xformer = xformer
 
+    # _read_lanes parses the lanes of netfile, caching them next to it so that
+    # later runs on an unchanged netfile can skip the XML parse.
+    @staticmethod
+    def _read_lanes(netfile: str):
+        cache = netfile + '.lanes.pkl'
+        if os.path.exists(cache) and os.path.getmtime(cache) > os.path.getmtime(netfile):
+            dbg(f"loading lanes from {cache}")
+            with open(cache, 'rb') as f:
+                rows = pickle.load(f)
+            return [{
+                "edge_id": edge_id,
+                "lane_id": lane_id,
+                "index":   index,
+                "speed":   speed,
+                "length":  length,
+                "points":  LineString(coords),
+            } for edge_id, lane_id, index, speed, length, coords in rows]
+
+        r = NetReader()
+        r.parse(netfile)
+        rows = [(l['edge_id'], l['lane_id'], l['index'], l['speed'], l['length'], shapely.get_coordinates(l['points'])) for l in r._data]
+        try:
+            # write atomically so that an interrupted run cannot leave a truncated cache behind
+            tmp = f'{cache}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache)
+        except OSError as e:
+            dbg(f"could not write lane cache {cache}: {e}")
+        return r._data
+
     def find(self, pos: Point, threshold: float = 0.1):
         traciPos = self._xformer.omnet2traci(pos)
-        nearest = self._edge_rtree.nearest(traciPos)
-        if nearest.distance(traciPos) > threshold:
-            raise ValueError(f'{traciPos.wkt} too far away from {nearest.wkt}')
-        return self._lane_lookup.get(id(nearest))
+        # the tree is built from self._lanes, so its indices are lane indices
+        lane = self._lanes[self._edge_rtree.nearest(traciPos)]
+        if lane['points'].distance(traciPos) > threshold:
+            raise ValueError(f'{traciPos.wkt} too far away from {lane["points"].wkt}')
+        return lane
+
+    # find_all returns the lane indices (see lane) for an array of positions of shape (N, 2) using a single tree query.
+    def find_all(self, positions, threshold: float = 0.1):
+        traci_x, traci_y = self._xformer.omnet2traci_arr(positions[:, 0], positions[:, 1])
+        traciPoints = shapely.points(traci_x, traci_y)
+        nearest_idx = self._edge_rtree.nearest(traciPoints)
+        distances = shapely.distance(traciPoints, self._edge_rtree.geometries.take(nearest_idx))
+        too_far = np.flatnonzero(distances > threshold)
+        if too_far.size > 0:
+            i = too_far[0]
+            raise ValueError(f'{traciPoints[i].wkt} too far away from {self._edge_rtree.geometries[nearest_idx[i]].wkt}')
+        return nearest_idx.astype(np.int32)
+
+    # lane returns the lane for a lane index returned by find_all
+    def lane(self, lane_idx):
+        return self._lanes[lane_idx]
 
 
 # ProximityHelper is a helper class for locating things within a certain radius
 class ProximityHelper:
-    # data should consist of [(thing_id, Point(thing_posx, thing_posy)], ...]
-    def __init__(self, data):
-        d = dict([(row[0], row[1]) for row in data])
-        self._lookup = dict([(id(point), thing_id) for thing_id, point in d.items()])
-        self._rtree = STRtree(d.values())
-
-    # Find returns all things and their locations within threshold of pos.
-    def find(self, pos: Point, threshold: float = 10.0):
-        out = []
-        query_geom = pos.buffer(threshold)
-        for result in self._rtree.query(query_geom):
-            thing_id = self._lookup[id(result)]
-            out.append((thing_id, result))
-        return out
-
-
-def is_following(up: Point, uc: Point, vp: Point, vc: Point) -> bool:
+    # positions should be an array of shape (N, 2) of [thing_posx, thing_posy]
+    def __init__(self, positions):
+        self._rtree = STRtree(shapely.points(positions))
+
+    # Find returns index arrays (input_idx, tree_idx) such that the thing at
+    # tree_idx is within thresholds[input_idx] of positions[input_idx].
+    # All positions are matched in a single tree query.
+    def find(self, positions, thresholds=10.0):
+        input_idx, tree_idx = self._rtree.query(shapely.points(positions), predicate='dwithin', distance=thresholds)
+        return input_idx, tree_idx
+
+
+# SpatialJoin finds the same pairs as ProximityHelper, but inside SQLite: the
+# positions of all rows in [start, end] (only whole seconds unless all_snapshots)
+# are indexed once in a temporary R*Tree table and the pairs of an instant come
+# from a single self-join.
+class SpatialJoin:
+    def __init__(self, conn, run_id, start, end, all_snapshots=False):
+        self._conn = conn
+        self._run_id = run_id
+        conn.execute(SQL_DROP_RTREE)
+        conn.execute(SQL_CREATE_RTREE)
+        conn.execute(SQL_FILL_RTREE, (run_id, start, end, all_snapshots))
+
+    # Find returns index arrays (follower_idx, leader_idx) into the snapshot arrays such that
+    # the leader is within speed * ttc of the follower at instant.
+    def find(self, snapshot, instant, ttc):
+        lookup = dict([(node_id, i) for i, node_id in enumerate(snapshot.ids)])
+        pairs = [
+            (lookup[follower], lookup[leader])
+            for follower, leader in self._conn.execute(SQL_RTREE_PAIRS, {'run_id': self._run_id, 'instant': instant, 'ttc': ttc})
+            # only vehicles present in both instants of the snapshot
+            if follower in lookup and leader in lookup
+        ]
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        return pairs[:, 0], pairs[:, 1]
+
+def is_following(up, uc, vp, vc):
     """For vehicles u and v, given previous and current positions up, uc, vp, vc
-    respectively, return True if u is behind (following) v, and False otherwise. 
+    respectively as arrays of shape (2,) or (K, 2), return a boolean array of
+    shape (K,) which is True where u is behind (following) v, and False otherwise.
 
     # u behind v, equal speeds
-    >>> is_following(Point(0, 0), Point(1, 0), Point(3, 0), Point(4, 0))
-    True
-    >>> is_following(Point(0, 0), Point(1, 0), Point(1, 0), Point(2, 0))
-    True
+    >>> is_following([0, 0], [1, 0], [3, 0], [4, 0])
+    array([ True])
+    >>> is_following([0, 0], [1, 0], [1, 0], [2, 0])
+    array([ True])
 
     # u ahead of v, equal speeds
-    >>> is_following(Point(3, 0), Point(4, 0), Point(0, 0), Point(1, 0))
-    False
-    >>> is_following(Point(1, 0), Point(2, 0), Point(0, 0), Point(1, 0))
-    False
+    >>> is_following([3, 0], [4, 0], [0, 0], [1, 0])
+    array([False])
+    >>> is_following([1, 0], [2, 0], [0, 0], [1, 0])
+    array([False])
 
     # u travelling in an opposite direction to v
-    >>> is_following(Point(2, 0), Point(1, 0), Point(3, 0), Point(4, 0))
-    False
+    >>> is_following([2, 0], [1, 0], [3, 0], [4, 0])
+    array([False])
 
     # u behind v, v faster than u
-    >>> is_following(Point(0, 0), Point(1, 0), Point(1, 0), Point(3, 0))
-    False
+    >>> is_following([0, 0], [1, 0], [1, 0], [3, 0])
+    array([False])
 
     # u ahead of v, v faster than u
-    >>> is_following(Point(3, 0), Point(4, 0), Point(0, 0), Point(3, 0))
-    False
+    >>> is_following([3, 0], [4, 0], [0, 0], [3, 0])
+    array([False])
 
     # u behind v, u faster than v
-    >>> is_following(Point(0, 0), Point(3, 0), Point(2, 0), Point(4, 0))
-    True
+    >>> is_following([0, 0], [3, 0], [2, 0], [4, 0])
+    array([ True])
 
     # u ahead of v, u faster than v
-    >>> is_following(Point(2, 0), Point(4, 0), Point(0, 0), Point(1, 0))
-    False
-    """
+    >>> is_following([2, 0], [4, 0], [0, 0], [1, 0])
+    array([False])
 
-    return (up.distance(vc) > up.distance(vp)) and (uc.distance(vc) <= up.distance(vp))
+    # one u against several v
+    >>> is_following([0, 0], [1, 0], [[3, 0], [1, 0]], [[4, 0], [3, 0]])
+    array([ True, False])
+    """
 
-# Vehicle represents a vehicle at a given point in time
-Vehicle = namedtuple('Vehicle', ['prev_pos', 'curr_pos', 'speed', 'controller'])
+    up, uc, vp, vc = [np.atleast_2d(np.asarray(a, dtype=np.float64)) for a in (up, uc, vp, vc)]
+    shape = np.broadcast_shapes(up.shape, uc.shape, vp.shape, vc.shape)
+    up, uc, vp, vc = [np.broadcast_to(a, shape) for a in (up, uc, vp, vc)]
+    out = np.empty(len(up), dtype=np.bool_)
+    is_following_batch(up[:, 0], up[:, 1], uc[:, 0], uc[:, 1], vp[:, 0], vp[:, 1], vc[:, 0], vc[:, 1], out)
+    return out
+
+# is_following_batch is the compiled kernel behind is_following, writing the result for pair i to out[i].
+# Squared distances suffice as the predicate only compares distances.
+@njit(parallel=True, fastmath=True, cache=True)
+def is_following_batch(upx, upy, ucx, ucy, vpx, vpy, vcx, vcy, out):
+    for i in prange(len(out)):
+        d_up_vp = (upx[i] - vpx[i]) ** 2 + (upy[i] - vpy[i]) ** 2
+        d_up_vc = (upx[i] - vcx[i]) ** 2 + (upy[i] - vcy[i]) ** 2
+        d_uc_vc = (ucx[i] - vcx[i]) ** 2 + (ucy[i] - vcy[i]) ** 2
+        out[i] = (d_up_vc > d_up_vp) and (d_uc_vc <= d_up_vp)
 
 # A Snapshot consists of vehicle data within two discrete instants i, j, i < j.
+# Vehicles are stored as parallel arrays: ids (N,), prev_xy (N, 2), curr_xy (N, 2), speed (N,) and controller (N,).
+# start_rows and end_rows consist of [(node_id, seconds, controller, posx, posy, speed), ...]
 class Snapshot:
-    def __init__(self, cursor, run_id, start, end):
-        self._data = {}
+    def __init__(self, run_id, start, end, start_rows, end_rows):
         start_data = {}
         end_data = {}
-        sql = '''
-            select node_id, controller, mobility_posx, mobility_posy, appl_speed
-            from results
-            where run_id = ?
-            and seconds = ?
-            and mobility_posx is not null
-            and mobility_posy is not null
-            and appl_speed is not null;
-        '''
-
-        start_rows = cursor.execute(sql, (run_id, start))
+
         for row in start_rows:
-            node_id, controller, xpos, ypos, _ = row
-            start_data[node_id] = (Point(xpos, ypos), controller)
+            node_id, _, _, xpos, ypos, _ = row
+            start_data[node_id] = (xpos, ypos)
 
-        end_rows = cursor.execute(sql, (run_id, end))
         for row in end_rows:
-            node_id, controller, xpos, ypos, speed = row
-            end_data[node_id] = (Point(xpos, ypos), speed, controller)
+            node_id, _, controller, xpos, ypos, speed = row
+            end_data[node_id] = (xpos, ypos, speed, controller)
 
         # we only care about vehicles in both start and end instants
-        common_ids = set(start_data.keys()).intersection(end_data.keys())
-        for common_id in common_ids:
-            self._data[common_id] = Vehicle(start_data[common_id][0], end_data[common_id][0], end_data[common_id][1], end_data[common_id][2])
-        dbg(f"snapshot init: run_id:{run_id} start:{start:.2f} end:{end:.2f} start_rows:{len(start_data.keys())} end_rows:{len(end_data.keys())} common_ids:{len(common_ids)}")
+        common_ids = sorted(set(start_data.keys()).intersection(end_data.keys()))
+        n = len(common_ids)
+        self.ids = np.array(common_ids, dtype=np.int64)
+        self.prev_xy = np.array([start_data[i] for i in common_ids], dtype=np.float64).reshape(n, 2)
+        self.curr_xy = np.array([end_data[i][:2] for i in common_ids], dtype=np.float64).reshape(n, 2)
+        self.speed = np.array([end_data[i][2] for i in common_ids], dtype=np.float64)
+        self.controller = np.array([end_data[i][3] for i in common_ids], dtype=object)
+        dbg(f"snapshot init: run_id:{run_id} start:{start:.2f} end:{end:.2f} start_rows:{len(start_data.keys())} end_rows:{len(end_data.keys())} common_ids:{n}")
 
     def vehicle_ids(self):
-        return self._data.keys()
+        return self.ids
 
-    def get(self, vehicle_id):
-        return self._data.get(vehicle_id)
+    def __len__(self):
+        return len(self.ids)
 
-    def items(self):
-        return self._data.items()
+def rows_by_instant(rows, instants):
+    """Bucket rows ordered by seconds, yielding (instant, [rows]) for each of
+    the given ascending instants. Instants without rows yield an empty bucket.
 
-    def start(self):
-        return [(k, v[0]) for k, v in self._data.items()]
+    >>> rows = [(1, 0.0, 'a'), (2, 0.0, 'b'), (1, 0.5, 'c'), (1, 2.0, 'd')]
+    >>> [(i, [r[2] for r in b]) for i, b in rows_by_instant(rows, [0.0, 1.0, 2.0])]
+    [(0.0, ['a', 'b']), (1.0, []), (2.0, ['d'])]
+    """
+    groups = groupby(rows, key=lambda row: row[1])
+    seconds, group = next(groups, (None, None))
+    for instant in instants:
+        while seconds is not None and seconds < instant:
+            seconds, group = next(groups, (None, None))
+        if seconds == instant:
+            yield instant, list(group)
+        else:
+            yield instant, []
+
+
+# state of a worker process, set up once by init_worker
+WORKER_ARGS = None
+WORKER_EDGE_LOOKUP = None
+
+def init_worker(args):
+    global DEBUG, WORKER_ARGS, WORKER_EDGE_LOOKUP
+    DEBUG = args.debug
+    WORKER_ARGS = args
+    # with several worker processes, parallelism comes from the processes, not numba's thread pool
+    if args.workers > 1:
+        set_num_threads(1)
+    xformer = CoordTransformer(Point(args.xform_x1, args.xform_y1), Point(args.xform_x2, args.xform_y2), args.xform_margin)
+    WORKER_EDGE_LOOKUP = EdgeLookup(args.netfile, xformer)
 
-    def end(self):
-        return [(k, v[1]) for k, v in self._data.items()]
 
-    def __len__(self):
-        return len(self._data.items())
+# process_instants looks for collisions in the snapshots between consecutive instants,
+# returning [(leader_node_id, follower_node_id, seconds, lane_id), ...].
+# It reads from its own connection so that it can run in a worker process.
+def process_instants(instants):
+    args = WORKER_ARGS
+    edge_lookup = WORKER_EDGE_LOOKUP
+    db_uri = f"file://{os.path.abspath(os.path.expanduser(args.dbpath))}?mode=ro"
+    conn = sqlite3.connect(db_uri, uri=True)
+    start_time, end_time = instants[0], instants[-1]
+
+    if args.spatial_join:
+        spatial_join = SpatialJoin(conn, args.run_id, start_time, end_time, args.all_snapshots)
+
+    collision_rows = []
+    # Fetch all vehicle data in the window at once; each instant is the end of one snapshot and the start of the next
+    prev_buckets, curr_buckets = tee(rows_by_instant(conn.execute(SQL_WINDOW, (args.run_id, start_time, end_time, args.all_snapshots)), instants))
+    next(curr_buckets, None)
+    for ((prev_instant, prev_rows), (curr_instant, curr_rows)) in zip(prev_buckets, curr_buckets):
+        snapshot = Snapshot(args.run_id, prev_instant, curr_instant, prev_rows, curr_rows)
+        print(f"processing snapshot run_id:{args.run_id} start:{prev_instant:.2f} end:{curr_instant:.2f} vehicles:{len(snapshot)}")
+        # A collision takes at least two vehicles
+        if len(snapshot) < 2:
+            continue
+        # Set danger radius equal to v_current * ttc_boundary
+        ttc_boundries = snapshot.speed * args.ttc
+        if args.spatial_join:
+            # Query the database rtree for every pair of node_ids N, M with M in the danger radius of N
+            follower_idx, leader_idx = spatial_join.find(snapshot, curr_instant, args.ttc)
+        else:
+            # Create a temporary rtree containing only node_ids in s_curr, indexed like the snapshot arrays
+            ph = ProximityHelper(snapshot.curr_xy)
+            # Query temporary rtree for every pair of node_ids N, M with M in the danger radius of N
+            follower_idx, leader_idx = ph.find(snapshot.curr_xy, ttc_boundries)
+        not_self = follower_idx != leader_idx
+        follower_idx, leader_idx = follower_idx[not_self], leader_idx[not_self]
+        if DEBUG:
+            foes = np.bincount(follower_idx, minlength=len(snapshot))
+            for i, vehicle_id in enumerate(snapshot.ids):
+                dbg(f"vehicle {vehicle_id}@{fmt_pos(snapshot.curr_xy[i])} has {foes[i]} foes within {ttc_boundries[i]:.2f}")
+        # Nothing more to do if no vehicle is within any other's danger radius
+        if follower_idx.size == 0:
+            continue
+        # Get current edge for each node_id from edge_rtree, once per snapshot
+        lane_idx = edge_lookup.find_all(snapshot.curr_xy)
+        # If En and Em differ, ignore
+        same_lane = lane_idx[follower_idx] == lane_idx[leader_idx]
+        if DEBUG:
+            for i, j in zip(follower_idx[~same_lane], leader_idx[~same_lane]):
+                dbg(f"ignoring nearby vehicle {snapshot.ids[j]}@{fmt_pos(snapshot.curr_xy[j])} for vehicle {snapshot.ids[i]}@{fmt_pos(snapshot.curr_xy[i])} on {edge_lookup.lane(lane_idx[i])['lane_id']} ")
+        follower_idx, leader_idx = follower_idx[same_lane], leader_idx[same_lane]
+        # If N is not following M, ignore -- we will catch M later
+        following = is_following(snapshot.prev_xy[follower_idx], snapshot.curr_xy[follower_idx], snapshot.prev_xy[leader_idx], snapshot.curr_xy[leader_idx])
+        if DEBUG:
+            for i, j in zip(follower_idx[~following], leader_idx[~following]):
+                dbg(f"vehicle {snapshot.ids[i]}@{fmt_pos(snapshot.curr_xy[i])} is not following vehicle {snapshot.ids[j]}@{fmt_pos(snapshot.curr_xy[j])}")
+        follower_idx, leader_idx = follower_idx[following], leader_idx[following]
+        # At this point, N and M are known to be on the same lane,
+        # N is known to be following M, and both N and M are within
+        # an unsafe stopping distance.
+        # One of them is going to crash into the other.
+        # Record a collision between N (follower) and M (leader)
+        for i, j in zip(follower_idx, leader_idx):
+            dbg(f"ttc < {args.ttc:.2f} between {snapshot.ids[i]}@{fmt_pos(snapshot.curr_xy[i])} travelling at {snapshot.speed[i]:.2f} and {snapshot.ids[j]}@{fmt_pos(snapshot.curr_xy[j])}")
+            collision_rows.append((int(snapshot.ids[j]), int(snapshot.ids[i]), curr_instant, edge_lookup.lane(lane_idx[i])['lane_id']))
+
+    conn.close()
+    return collision_rows
+
 
 __HELP__ = '''Look for collisions in a traffic dataset.\n
 
@@ -216,89 +476,56 @@ def main():
     parser.add_argument("--end_time", type=float, help="end time (exclusive)")
     parser.add_argument("--ttc", type=float, help="time to collision", default=1.0)
     parser.add_argument("--all_snapshots", default=False, action='store_true', help='process all snapshots, not only whole seconds')
+    parser.add_argument("--spatial_join", default=False, action='store_true', help='find nearby vehicles with an SQLite R*Tree self-join instead of in memory')
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes, defaults to the number of CPUs")
     args = parser.parse_args()
 
     global DEBUG
     DEBUG = args.debug
 
-    dbg("shapely speedups available: {speedups.enabled}")
-
-    xformer = CoordTransformer(Point(args.xform_x1, args.xform_y1), Point(args.xform_x2, args.xform_y2), args.xform_margin)
-    edge_lookup = EdgeLookup(args.netfile, xformer)
-
     db_uri = f"file://{os.path.abspath(os.path.expanduser(args.dbpath))}?mode=rw"
     conn = sqlite3.connect(db_uri, uri=True)
+    conn.execute('pragma synchronous = NORMAL;')
+    conn.execute('pragma journal_mode = WAL;')
     c = conn.cursor()
-
-    sql_create_table_colisions = '''
-    create table if not exists collisions (
-        leader_node_id integer,
-        follower_node_id integer,
-        seconds real,
-        lane_id string,
-        primary key (leader_node_id, follower_node_id, seconds)
-    );
-    '''
-    c.execute(sql_create_table_colisions)
-    sql_insert_collision = 'insert or ignore into collisions values (?, ?, ?, ?);'
+    c.execute(SQL_CREATE_INDEX)
+    c.execute(SQL_CREATE_TABLE_COLLISIONS)
+    conn.commit()
 
     start_time = args.start_time
     if start_time is None:
-        start_time = c.execute('select min(seconds) from results where run_id = ?', (args.run_id,)).fetchone()[0]
+        start_time = c.execute(SQL_MIN_SECONDS, (args.run_id,)).fetchone()[0]
 
     end_time = args.end_time
     if end_time is None:
-        end_time = c.execute('select max(seconds) from results where run_id = ?', (args.run_id,)).fetchone()[0]
-
-    sql_instants = '''
-        select distinct seconds from results
-        where seconds >= ?
-        and seconds <= ?
-        order by seconds asc;
-    '''
-    instants = [float(row[0]) for row in c.execute(sql_instants, (args.start_time, args.end_time))]
+        end_time = c.execute(SQL_MAX_SECONDS, (args.run_id,)).fetchone()[0]
+
+    instants = [float(row[0]) for row in c.execute(SQL_INSTANTS, (start_time, end_time))]
     # HACK: for some reason, snapshots that are a fraction of a second after a whole second have incomplete data. Ignore these.
     if not args.all_snapshots:
         instants = [i for i in instants if i.is_integer()]
-    dbg(f"found {len(instants)} instants between {args.start_time:.2f} and {args.end_time:.2f}")
-    for (prev_instant, curr_instant) in zip(instants, instants[1:]):
-        snapshot = Snapshot(c, args.run_id, prev_instant, curr_instant)
-        # Create a temporary rtree containing only node_ids in s_curr, mapping their node_ids to their xy positions
-        ph = ProximityHelper(snapshot.end())
-        print(f"processing snapshot run_id:{args.run_id} start:{prev_instant:.2f} end:{curr_instant:.2f} vehicles:{len(snapshot)}")
-        # For each node_id N in instant:
-        for vehicle_id, vehicle in snapshot.items():
-            # Get current edge En for N from edge_rtree
-            vehicle_lane_id = edge_lookup.find(vehicle.curr_pos)['lane_id']
-            # Set danger radius equal to v_current * ttc_boundary
-            ttc_boundry = vehicle.speed * args.ttc
-            # Query temporary rtree for node_ids in danger radius
-            nearby_vehicles = ph.find(vehicle.curr_pos, ttc_boundry)
-            dbg(f"vehicle {vehicle_id}@{vehicle.curr_pos.wkt} has {len(nearby_vehicles)} foes within {ttc_boundry:.2f}")
-            # For each node_id M in danger radius:
-            for nearby_vehicle_id, _ in nearby_vehicles:
-                if nearby_vehicle_id == vehicle_id:
-                    continue
-                nearby_vehicle = snapshot.get(nearby_vehicle_id)
-                # Get current edge Em for M from edge_rtree
-                nearby_vehicle_lane_id = edge_lookup.find(nearby_vehicle.curr_pos)['lane_id']
-                # If En and Em differ, ignore
-                if nearby_vehicle_lane_id != vehicle_lane_id:
-                    dbg(f"ignoring nearby vehicle {nearby_vehicle_id}@{nearby_vehicle.curr_pos.wkt} for vehicle {vehicle_id}@{vehicle.curr_pos.wkt} on {vehicle_lane_id} ")
-                    continue
-                # If N is not following M, ignore -- we will catch M later
-                if not is_following(vehicle.prev_pos, vehicle.curr_pos, nearby_vehicle.prev_pos, nearby_vehicle.curr_pos):
-                    dbg(f"vehicle {vehicle_id}@{vehicle.curr_pos.wkt} is not following vehicle {nearby_vehicle_id}@{nearby_vehicle.curr_pos.wkt}")
-                    continue
-                # At this point, N and M are known to be on the same lane,
-                # N is known to be following M, and both N and M are within
-                # an unsafe stopping distance.
-                # One of them is going to crash into the other.
-                # Record a collision between N (follower) and M (leader)
-                # TODO: write to database
-                dbg(f"ttc < {args.ttc:.2f} between {vehicle_id}@{vehicle.curr_pos.wkt} travelling at {vehicle.speed:.2f} and {nearby_vehicle_id}@{nearby_vehicle.curr_pos.wkt}")
-                c.execute(sql_insert_collision, (nearby_vehicle_id, vehicle_id, curr_instant, vehicle_lane_id))
-                conn.commit()
+    dbg(f"found {len(instants)} instants between {start_time:.2f} and {end_time:.2f}")
+
+    # Snapshots are independent, so split them into chunks of consecutive instants.
+    # Neighbouring chunks share their boundary instant so that no snapshot is lost.
+    workers = max(1, args.workers)
+    chunk_size = max(1, -(-(len(instants) - 1) // (workers * 4)))
+    chunks = [instants[k:k + chunk_size + 1] for k in range(0, len(instants) - 1, chunk_size)]
+
+    if workers == 1:
+        init_worker(args)
+        for collision_rows in map(process_instants, chunks):
+            # write all collisions of a chunk in one transaction
+            c.executemany(SQL_INSERT_COLLISION, collision_rows)
+            conn.commit()
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(args,)) as executor:
+        futures = [executor.submit(process_instants, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            # write all collisions of a chunk in one transaction
+            c.executemany(SQL_INSERT_COLLISION, future.result())
+            conn.commit()
 
 
 if __name__ == "__main__":
@@ -4,14 +4,24 @@ import argparse
 import os
 import sqlite3
 import sys
-import xml
+
+import numpy as np
+import shapely
 
 from copy import deepcopy
-from xml.sax.handler import ContentHandler
-from statistics import stdev
+from lxml import etree
 from shapely.geometry import Point, LineString
 from shapely.strtree import STRtree
 
+if int(shapely.__version__.split('.')[0]) < 2:
+    raise ImportError(f'shapely >= 2.0 is required, found {shapely.__version__}')
+
+SQL_MIN_SECONDS = 'select min(seconds) from results where run_id = ?'
+
+SQL_MAX_SECONDS = 'select max(seconds) from results where run_id = ?'
+
+SQL_SAMPLES = '''select node_id, seconds, mobility_posx, mobility_posy, appl_speed from results where run_id = ? and seconds >= ? and seconds < ? and mobility_posx is not null and mobility_posy is not null and appl_speed is not null order by seconds asc;'''
+
 DEBUG = True
 
 def dbg(msg):
@@ -27,54 +37,57 @@ class CoordTransformer:
         self._topleft = topleft
         self._bottomright = bottomright
         self._margin = margin
+        # omnet2traci is the affine map x' = x + ax, y' = ay - y
+        self._ax = topleft.x - margin
+        self._ay = self._dimensions.y + topleft.y + margin
 
     def omnet2traci(self, p):
-        return Point(p.x + self._topleft.x - self._margin, self._dimensions.y - (p.y - self._topleft.y) + self._margin)
+        return Point(p.x + self._ax, self._ay - p.y)
+
+    # omnet2traci_arr is omnet2traci for arrays of x and y values
+    def omnet2traci_arr(self, x, y):
+        return x + self._ax, self._ay - y
     
     def traci2omnet(self, p):
         return Point(p.x - self._topleft.x + self._margin, self._dimensions.y - (p.y - self._topleft.y) + self._margin)
 
 
 # Class for reading a SUMO network XML file
-class NetReader(ContentHandler):
+class NetReader:
     def __init__(self):
-        self._edge_id = None
         self._data = []
-    
-    def startElement(self, name, attrs):
-        if name == "edge":
-            self._edge_id = attrs.get("id")
-        
-        if name == "lane":
-            points = []
-            for s in attrs.get("shape", "").split(" "):
-                parts = s.split(",")
-                p = Point(float(parts[0]), float(parts[1]))
-                points.append(p) # this is a raw TraCI point
-
-            self._data.append({
-                "edge_id": self._edge_id,
-                "lane_id": attrs["id"],
-                "index":   int(attrs.get("index", -1)),
-                "speed":   float(attrs.get("speed", -1)),
-                "length":  float(attrs.get("length", -1)),
-                "points":  LineString(points),
-            })
-            return
+
+    def parse(self, netfile):
+        for _, elem in etree.iterparse(netfile, events=("end",), tag=("edge", "lane")):
+            if elem.tag == "lane":
+                # raw TraCI points "x1,y1 x2,y2 ..." parsed in one pass
+                points = np.fromstring(elem.get("shape", "").replace(",", " "), sep=" ").reshape(-1, 2)
+
+                self._data.append({
+                    "edge_id": elem.getparent().get("id"),
+                    "lane_id": elem.get("id"),
+                    "index":   int(elem.get("index", -1)),
+                    "speed":   float(elem.get("speed", -1)),
+                    "length":  float(elem.get("length", -1)),
+                    "points":  LineString(points),
+                })
+                elem.clear()
+                continue
+
+            # edges are done with once all their lanes are read
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
 # returns a mapping of key -> average of d[key] in dicts
 def group_by_avg(dicts, key, value):
-    tmp = {}
-    ret = {}
+    sums = {}
+    counts = {}
     for d in dicts:
         k = d[key]
-        if k not in tmp:
-            tmp[k] = list()
-        tmp[k].append(d[value])
-    for k, v in tmp.items():
-        ret[k] = sum(v) / len(v)
-    del(tmp)
-    return ret
+        sums[k] = sums.get(k, 0.0) + d[value]
+        counts[k] = counts.get(k, 0) + 1
+    return dict([(k, sums[k] / counts[k]) for k in sums])
 
 
 def main():
@@ -98,13 +111,9 @@ def main():
 
     xformer = CoordTransformer(Point(args.xform_x1, args.xform_y1), Point(args.xform_x2, args.xform_y2), args.xform_margin)
 
-    xp = xml.sax.make_parser()
-    xp.setFeature(xml.sax.handler.feature_namespaces, 0)
     r = NetReader()
-    xp.setContentHandler(r)
-    xp.parse(args.netfile)
+    r.parse(args.netfile)
     lanes = deepcopy(r._data)
-    lookup = dict([(id(l['points']), l) for l in lanes])
     rtree = STRtree([l['points'] for l in lanes])
 
     db_uri = f"file://{os.path.abspath(os.path.expanduser(args.dbpath))}?mode=ro"
@@ -113,16 +122,15 @@ def main():
 
     start_time = args.start_time
     if start_time is None:
-        start_time = c.execute('select min(seconds) from results where run_id = ?', (args.run_id,)).fetchone()[0]
+        start_time = c.execute(SQL_MIN_SECONDS, (args.run_id,)).fetchone()[0]
 
     end_time = args.end_time
     if end_time is None:
-        end_time = c.execute('select max(seconds) from results where run_id = ?', (args.run_id,)).fetchone()[0]
+        end_time = c.execute(SQL_MAX_SECONDS, (args.run_id,)).fetchone()[0]
 
-    sql = '''select node_id, seconds, mobility_posx, mobility_posy, appl_speed from results where run_id = ? and seconds >= ? and seconds < ? and mobility_posx is not null and mobility_posy is not null and appl_speed is not null order by seconds asc;'''
     query_args = (args.run_id, start_time, end_time)
 
-    # map of edge_id -> [list of samples]
+    # map of edge_id -> {"speeds": ndarray of samples}
     edgedata = dict()
     # map of edge_id -> speed
     edge2speed = group_by_avg(lanes, 'edge_id', 'speed')
@@ -143,38 +151,47 @@ def main():
     # for k, v in tmpspeed.items():
     #     edge2speed[k] = sum(v) / len(v)
 
-    for row in c.execute(sql, query_args):
-        node_id, seconds, posx, posy, speed = row
-        traciPoint = xformer.omnet2traci(Point(posx, posy))
-        nearest = rtree.nearest(traciPoint)
-
-        lane = lookup[id(nearest)]
-        edge_id = lane['edge_id']
-        distance = nearest.distance(traciPoint)
-        if distance > 0.1:
-            raise ValueError(f'{traciPoint.wkt} too far away from {nearest.wkt}')
-
-        if edge_id not in edgedata:
-            edgedata[edge_id] = {
-                'speeds': [speed],
-            }
-        else:
-            edgedata[edge_id]['speeds'].append(speed)
+    rows = c.execute(SQL_SAMPLES, query_args).fetchall()
+    posx = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+    posy = np.fromiter((row[3] for row in rows), dtype=np.float64, count=len(rows))
+    speeds = np.fromiter((row[4] for row in rows), dtype=np.float64, count=len(rows))
+    del(rows)
+
+    traci_x, traci_y = xformer.omnet2traci_arr(posx, posy)
+    traciPoints = shapely.points(traci_x, traci_y)
+    nearest_idx = rtree.nearest(traciPoints)
+    distances = shapely.distance(traciPoints, rtree.geometries.take(nearest_idx))
+    too_far = np.flatnonzero(distances > 0.1)
+    if too_far.size > 0:
+        i = too_far[0]
+        raise ValueError(f'{traciPoints[i].wkt} too far away from {rtree.geometries[nearest_idx[i]].wkt}')
+
+    # group speed samples by edge, keeping edges in order of first appearance
+    edge_ids = list(dict.fromkeys(lane['edge_id'] for lane in lanes))
+    edge_idx = dict([(edge_id, i) for i, edge_id in enumerate(edge_ids)])
+    lane2edge = np.array([edge_idx[lane['edge_id']] for lane in lanes], dtype=np.int64)
+    row_edges = lane2edge[nearest_idx]
+    order = np.argsort(row_edges, kind='stable')
+    group_edges, group_starts = np.unique(row_edges[order], return_index=True)
+    group_speeds = np.split(speeds[order], group_starts[1:])
+    for g in np.argsort(order[group_starts]):
+        edgedata[edge_ids[group_edges[g]]] = {
+            'speeds': group_speeds[g],
+        }
 
     if args.outfile is None:
         outfile = sys.stdout
     else:
         outfile = open(args.outfile, 'w')
     
-    # TODO: actually generate the XML element tree properly
-    outfile.write("<meandata>\n")
-    outfile.write(f"<interval begin=\"{start_time}\" end=\"{end_time}\">\n")
+    root = etree.Element("meandata")
+    interval = etree.SubElement(root, "interval", begin=str(start_time), end=str(end_time))
     for edge_id, edge_dict in edgedata.items():
-        n = len(edge_dict['speeds'])
-        avg_speed = sum(edge_dict['speeds']) / n # average speed in m/s
-        min_speed, max_speed = min(edge_dict['speeds']), max(edge_dict['speeds'])
-        if len(edge_dict['speeds']) > 2:
-            stdev_speed = stdev(edge_dict['speeds'])
+        speeds = edge_dict['speeds']
+        avg_speed = speeds.mean() # average speed in m/s
+        min_speed, max_speed = speeds.min(), speeds.max()
+        if speeds.size > 2:
+            stdev_speed = speeds.std(ddof=1)
         else:
             stdev_speed = "" # hack
         travel_rate_mpkm = 1 / avg_speed * 16.667
@@ -183,9 +200,18 @@ def main():
         expected_travel_time = edge_len / edge_speed
         actual_travel_time =  edge_len / avg_speed
         cidx = (actual_travel_time - expected_travel_time) / expected_travel_time
-        outfile.write(f"<edge id=\"{edge_id}\" speed=\"{edge_speed}\" length=\"{edge_len}\" avg_speed=\"{avg_speed}\" min_speed=\"{min_speed}\" max_speed=\"{max_speed}\" stdev_speed=\"{stdev_speed}\" travelrate=\"{travel_rate_mpkm}\" congestion_index=\"{cidx}\"/>\n")
-    outfile.write("</interval>\n")
-    outfile.write("</meandata>\n")
+        etree.SubElement(interval, "edge",
+            id=edge_id,
+            speed=str(edge_speed),
+            length=str(edge_len),
+            avg_speed=str(avg_speed),
+            min_speed=str(min_speed),
+            max_speed=str(max_speed),
+            stdev_speed=str(stdev_speed),
+            travelrate=str(travel_rate_mpkm),
+            congestion_index=str(cidx),
+        )
+    outfile.write(etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="UTF-8").decode())
     outfile.close()
 
 if __name__ == "__main__":
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
+import mmap
+import os
 import re
 import sqlite3
 
 
-VEC_COLS = set([s.strip() for s in '''
+# ordered to match the column order of SQL_CREATE_TABLE
+VEC_COLS = [s.strip() for s in '''
     mobility_posx
     mobility_posy
     mobility_acceleration
@@ -22,7 +25,7 @@ VEC_COLS = set([s.strip() for s in '''
     prot_nodeId
     prot_busyTime
     prot_collisions
-'''.split('\n') if s])
+'''.split('\n') if s]
 
 SQL_CREATE_TABLE = '''
 create table if not exists results (
@@ -55,33 +58,70 @@ create table if not exists results (
 RUNVARS = {}
 VECIDS = {}
 
+SQL_PRAGMAS = [
+    'pragma journal_mode = WAL;',
+    'pragma synchronous = OFF;',
+    'pragma temp_store = MEMORY;',
+    'pragma cache_size = -262144;',
+]
+
+SQL_INSERT_ROW = f'''insert or replace into results (node_id, run_id, seconds, frame_error_rate, controller, mpr, {', '.join(VEC_COLS)})
+    values ({', '.join(['?'] * (6 + len(VEC_COLS)))});'''
+
+# numeric sample lines are "<vector_id> <event_no> <time> <value>"
+_NUMLINE = re.compile(rb'^(\d+)\s+\S+\s+(\S+)\s+(\S+)')
+_RUNID = re.compile(r'^[^-]+-([0-9]+)')
+_NODE_ID = re.compile(r'^.*?\[([0-9]+)\]')
+_VECSRC_LAST = re.compile(r'^.+?\.([^\.]+)$')
+
 def handle_one(conn, f):
     nrows = 0
+    # map of (node_id, run_id, seconds) -> {colname: value}
+    rows = {}
+    run_attrs = None
     try:
         s = f.readline()
-        if not s.startswith('version'):
+        if not s.startswith(b'version'):
             raise ValueError('expected version line')
-        version = int(s.strip().split(' ')[1])
+        version = int(s.strip().split(b' ')[1])
         if version != 2:
             raise ValueError('unexpected version: ' + version)
 
         s = f.readline()
-        if not s.startswith('run'):
+        if not s.startswith(b'run'):
             raise ValueError('expected run identifier')
-        runid_str = s.strip().split(' ')[1]
-        runid = int(re.search(r'^[^-]+-([0-9]+)', runid_str).group(1))
+        runid_str = s.strip().split(b' ')[1].decode()
+        runid = int(_RUNID.search(runid_str).group(1))
         f.seek(0)
-        for line in f:
-            if not line.strip():
-                continue
-            try:
-                start, rest = line.replace('\t', ' ').strip().split(' ', maxsplit=1)
-            except ValueError:
-                import pdb; pdb.set_trace()
-            if start == 'version':
+        conn.execute('begin;')
+        for line in iter(f.readline, b''):
+            m = _NUMLINE.match(line)
+            if m is not None:
+                node_id, colname = VECIDS[int(m.group(1))]
+                # run attributes all precede the first vector sample
+                if run_attrs is None:
+                    frame_error_rate = float(RUNVARS['*.**.nic.mac1609_4.frameErrorRate'])
+                    controller = RUNVARS['*.node[*].scenario.controller'].replace('\\"', '')
+                    mpr = float(RUNVARS['**.mpr'])
+                    run_attrs = (frame_error_rate, controller, mpr)
+                # ignore unknown columns
+                if colname is None:
+                    continue
+
+                # samples of one row are spread across vectors, so assemble rows in memory
+                key = (node_id, runid, float(m.group(2)))
+                if key not in rows:
+                    rows[key] = {}
+                rows[key][colname] = float(m.group(3))
+                nrows += 1
+                if nrows % 100000 == 0:
+                    print(f'{nrows} rows processed')
                 continue
-            if start == 'run':
+
+            line = line.decode()
+            if not line.strip():
                 continue
+            start, rest = line.replace('\t', ' ').strip().split(' ', maxsplit=1)
             if start in ['attr', 'itervar', 'param']:
                 attrname, attrval = rest.split(' ', maxsplit=1)
                 RUNVARS[attrname] = attrval
@@ -90,41 +130,25 @@ def handle_one(conn, f):
                 vector_id, vector_src, vector_name, etv = rest.split(' ', maxsplit=3)
                 if etv != 'ETV':
                     raise ValueError('expected ETV but got ' + etv)
-                node_id = int(re.search(r'^.*?\[([0-9]+)\]', vector_src).group(1))
-                VECIDS[int(vector_id)] = (node_id, vector_src, vector_name)
-                continue
-            if start.isdigit():
-                vector_id = int(start)
-                _, vectime_str, vecvalue_str = rest.split(' ', maxsplit=2)
-                vectime = float(vectime_str)
-                vecvalue = float(vecvalue_str)
-                node_id, vector_src, vector_name = VECIDS[vector_id]
-                frame_error_rate = float(RUNVARS['*.**.nic.mac1609_4.frameErrorRate'])
-                controller = RUNVARS['*.node[*].scenario.controller'].replace('\\"', '')
-                mpr = float(RUNVARS['**.mpr'])
-                # attempt to create the row with default values ignoring duplicates
-                sql = 'insert or ignore into results (node_id, run_id, seconds, frame_error_rate, controller, mpr) values (?, ?, ?, ?, ?, ?);'
-                conn.execute(sql, (node_id, runid, vectime, frame_error_rate, controller, mpr))
-
-                vecsrc_last = re.search(r'^.+?\.([^\.]+)$', vector_src).group(1)
+                node_id = int(_NODE_ID.search(vector_src).group(1))
+                vecsrc_last = _VECSRC_LAST.search(vector_src).group(1)
                 colname = f'{vecsrc_last}_{vector_name}'
-                # ignore unknown columns
+                # unknown columns are flagged once here rather than on every sample
                 if colname not in VEC_COLS:
-                    continue
-
-                # then attempt to update the row
-                sql = f'update results set {colname} = ? where node_id = ? and run_id = ? and seconds = ?;'
-                conn.execute(sql, (vecvalue, node_id, runid, vectime))
-                nrows += 1
-                if nrows % 100000 == 0:
-                    print(f'{nrows} rows processed')
-
-        # finally delete rows missing important data, using one column as a proxy
-        sql = f'delete from results where appl_distanceTravelled is null;'
-        conn.execute(sql)
+                    colname = None
+                VECIDS[int(vector_id)] = (node_id, colname)
+                continue
     except Exception as e:
         print(e)
     finally:
+        # write one row per instant, skipping rows missing important data using one column as a proxy.
+        # This also keeps the rows read before an error, like the old per-line inserts did.
+        if rows:
+            conn.executemany(SQL_INSERT_ROW, (
+                key + run_attrs + tuple(cols.get(colname) for colname in VEC_COLS)
+                for key, cols in rows.items()
+                if 'appl_distanceTravelled' in cols
+            ))
         conn.commit()
     
 
@@ -135,12 +159,19 @@ def main():
     args = parser.parse_args()
 
     conn = sqlite3.connect(args.output)
+    for pragma in SQL_PRAGMAS:
+        conn.execute(pragma)
     conn.execute(SQL_CREATE_TABLE)
 
     for fname in args.input:
         print(f'processing {fname}')
-        with open('HighTraffic_"CACC"_mpr0.2_fer70_rep0.vec', 'r') as f:
-            handle_one(conn, f)
+        with open(fname, 'rb') as f:
+            # empty files cannot be mapped, let handle_one report them like any other bad input
+            if os.fstat(f.fileno()).st_size == 0:
+                handle_one(conn, f)
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                handle_one(conn, mm)
 
 
 